@@ -1,6 +1,8 @@
 # --- IMPORTS --- 
 import math
-import datetime 
+import functools
+from collections import namedtuple
+import numba
 import numpy as np
 import pandas as pd
 
@@ -16,78 +18,332 @@ DISTANCE_COLUMN = "distance"
 LATITUDE_COLUMN = "latitude"
 LONGITUDE_COLUMN = "longitude"
 YEAR_COLUMN = "year"
+YEAR_DTYPE = np.int32 #Type of years in payouts indexes
 
 # PAYOUT STRUCTURE DATA MODEL DEFINITION
 PAYOUT_RADIUS = "Radius"
 PAYOUT_MAGNITUDE = "Magnitude"
 PAYOUT_PERCENTAGE = "Payout"
+#Payout structure as one contiguous float64 array per criteria (see "load_payout_table")
+PayoutTable = namedtuple("PayoutTable", ["radius", "magnitude", "percentage"])
 
-def get_haversine_distance(blist_lat,blist_lon,a_lat,a_lon):
+# NUMBA COMPILATION OPTIONS
+#Fast math flags used by compiled kernels. Left out:
+#   - "contract": FMA contraction of the degrees to radians conversion breaks the exact 0 distance between identical points
+#   - "nnan", "ninf": coordinates or magnitudes may be missing (NaN) in USGS data
+_FASTMATH_FLAGS = {"nsz", "arcp", "afn", "reassoc"}
+
+@numba.njit(fastmath=_FASTMATH_FLAGS, cache=True)
+def _haversine(b_lat, b_lon, a_phi, a_lambda, cos_a_phi):
+    """Compiled haversine distance between point A and a single point B, in km. See "get_haversine_distance" for details.
+    Point B lat/lon are in decimal degrees. Point A is given in radians (a_phi, a_lambda) along with cos(a_phi):
+    these are invariant over points B and must be computed once by the caller.
+    """
+    #Convert lat/lon of point B from decimal degrees to radians
+    b_lambda = math.radians(b_lon)
+    b_phi = math.radians(b_lat)
+
+    #Compute haversine distance (see wikipeadia reference in "get_haversine_distance")
+    sin_half_delta_phi = math.sin((b_phi - a_phi) * 0.5)
+    sin_half_delta_lambda = math.sin((b_lambda - a_lambda) * 0.5)
+    hav = sin_half_delta_phi * sin_half_delta_phi + cos_a_phi * math.cos(b_phi) * sin_half_delta_lambda * sin_half_delta_lambda
+    #Clamp to guard against rounding slightly above 1 (fastmath) for antipodal points
+    hav = min(hav, 1.0)
+    #atan2 form of the central angle: keeps precision near antipodes, where asin(sqrt(hav)) degrades
+    return 2 * EARTH_RADIUS * math.atan2(math.sqrt(hav), math.sqrt(1.0 - hav))
+
+@numba.njit(parallel=True, fastmath=_FASTMATH_FLAGS, cache=True)
+def _haversine_kernel(blist_lat, blist_lon, a_lat, a_lon, out):
+    """Compiled kernel of "get_haversine_distance". Fills "out" with the haversine distances, in km.
+    blist_lat, blist_lon and out must be contiguous float arrays of the same length and dtype. a_lat, a_lon are floats. All angles in decimal degrees.
+    """
+    #Convert lat/lon of point A from decimal degrees to radians, once for all points B
+    a_lambda = math.radians(a_lon)
+    a_phi = math.radians(a_lat)
+    cos_a_phi = math.cos(a_phi)
+
+    for i in numba.prange(blist_lat.shape[0]):
+        out[i] = _haversine(blist_lat[i], blist_lon[i], a_phi, a_lambda, cos_a_phi)
+
+def get_haversine_distance(blist_lat,blist_lon,a_lat,a_lon,dtype=np.float32):
     """This function computes the haversine distance between point A and a list of points B.
     The haversine distance is the distance between two point on the surface of the earth, along a great circle.
     Refer to https://en.wikipedia.org/wiki/Haversine_formula 
+    Computation is performed by a compiled (numba) kernel, parallelized over points B.
 
     Parameters
     ---------- 
-        blist_lat: list of float
-            List of latitude of all points B, in decimal degrees. Must be of the same length as blist_lon
-        blist_lon: list of float
-            List of longitude of all points B, in decimal degrees. Must be of the same length as blist_lat
+        blist_lat: 1-D ndarray of float (or list, Series)
+            Latitude of all points B, in decimal degrees. Must be of the same length as blist_lon.
+            Contiguous arrays of type "dtype" are used as is, other inputs are converted (copied).
+        blist_lon: 1-D ndarray of float (or list, Series)
+            Longitude of all points B, in decimal degrees. Must be of the same length as blist_lat. Same conversion as blist_lat.
         a_lat: float
             Latitude of point A, in decimal degrees.
         a_lon: float, optional
             Longitude of point A, in decimal degrees.
+        dtype: numpy float type, optional
+            Float type (e.g. np.float32 or np.dtype('float64')) used for points A and B and for the result. Defaults to float32, which halves memory traffic
+            but is not lossless: rounding of coordinates and cancellation in the differences of angles yield errors of up to several metres
+            (e.g. a point at 9.9999995 km is computed at 10.000074 km). Comparisons against payout radii may thus differ from float64
+            for points within a few metres of a radius. Use float64 for full precision.
 
     Returns
     -------
-        list of float
-            List of haversine distances between A and each points B, in km.
+        ndarray of float
+            Array of haversine distances between A and each points B, in km, of type "dtype" (float32 by default).
+            Can be assigned as is to a DataFrame column (e.g. DISTANCE_COLUMN).
+
+    Raises
+    ------
+        ValueError
+            If blist_lat or blist_lon is not 1-D (e.g. a scalar), or if they are not of the same length.
     """
-    #Convert lat/lon of point A from decimal degrees to radians
-    a_lambda = np.deg2rad(a_lon)
-    a_phi = np.deg2rad(a_lat)
+    #Accept both scalar types (np.float32) and dtypes (np.dtype('float32')): the scalar type is used to cast point A
+    dtype = np.dtype(dtype).type
 
-    #Convert lat/lon of point B from decimal degrees to radians
-    b_lambda = np.deg2rad(blist_lon)
-    b_phi = np.deg2rad(blist_lat)
+    #Validate inputs: the kernel does not check bounds, so points B must be 1-D and of the same length
+    if np.ndim(blist_lat) != 1 or np.ndim(blist_lon) != 1:
+        raise ValueError("get_haversine_distance: blist_lat and blist_lon must be 1-D")
+    if len(blist_lat) != len(blist_lon):
+        raise ValueError(f"get_haversine_distance: blist_lat and blist_lon must have the same length ({len(blist_lat)} != {len(blist_lon)})")
+
+    #Convert inputs (lists, Series or arrays) to contiguous arrays, as expected by the kernel
+    blist_lat = np.ascontiguousarray(blist_lat, dtype=dtype)
+    blist_lon = np.ascontiguousarray(blist_lon, dtype=dtype)
 
-    #Compute haversine distance (see wikipeadia reference above)
-    res = (2*EARTH_RADIUS*np.arcsin( \
-        np.sqrt( \
-            np.sin((b_phi - a_phi)/2) ** 2 + np.cos(a_phi)*np.cos(b_phi)*np.sin((b_lambda - a_lambda)/2) ** 2
-        )
-    ))
+    res = np.empty(blist_lat.shape[0], dtype=dtype)
+    #Point A is cast to the same type so that identical points yield an exact 0 distance
+    _haversine_kernel(blist_lat, blist_lon, dtype(a_lat), dtype(a_lon), res)
 
     return res
     
+def load_payout_table(payout_structure):
+    """This function converts a payout structure to a PayoutTable: one array per criteria, ready to be used by payout computations.
+    Converting once avoids DataFrame column lookups and conversions each time payouts are computed with the same payout structure.
+
+    Parameters
+    ---------- 
+        payout_structure: DataFrame or PayoutTable
+            DataFrame containing the payout structure. See "compute_payout_item" doc for description. A PayoutTable is returned as is.
+
+    Returns
+    -------
+        PayoutTable
+            radius, magnitude, percentage: contiguous float64 arrays of the PAYOUT_RADIUS, PAYOUT_MAGNITUDE and PAYOUT_PERCENTAGE criteria
+    """
+    if isinstance(payout_structure, PayoutTable):
+        return payout_structure
+    #float64 rather than float32: a rounded magnitude criteria could reject earthquakes exactly at the criteria (float32(4.55) > 4.55)
+    return PayoutTable(
+        radius=np.ascontiguousarray(payout_structure[PAYOUT_RADIUS].to_numpy(dtype=np.float64)),
+        magnitude=np.ascontiguousarray(payout_structure[PAYOUT_MAGNITUDE].to_numpy(dtype=np.float64)),
+        percentage=np.ascontiguousarray(payout_structure[PAYOUT_PERCENTAGE].to_numpy(dtype=np.float64))
+    )
+
+def _sort_payout_rules(radius_thresholds, magnitude_thresholds, percentages):
+    """Sorts payout rules by radius, then magnitude (ascending), then payout (descending). Returns the 3 sorted arrays."""
+    order = np.lexsort((-percentages, magnitude_thresholds, radius_thresholds))
+    return radius_thresholds[order], magnitude_thresholds[order], percentages[order]
+
+def is_payout_ladder(payout_structure):
+    """This function checks whether a payout structure is a ladder: when rules are sorted by increasing radius,
+    magnitude criteria never decrease and payouts never increase (e.g. 100% within 10km from magnitude 4.5, 75% within 50km from magnitude 5.5, ...).
+    Payouts of a ladder can be computed with a binary search instead of testing all rules (see "compute_payouts").
+
+    Parameters
+    ---------- 
+        payout_structure: DataFrame or PayoutTable
+            Payout structure. See "compute_payout_item" doc for description
+
+    Returns
+    -------
+        bool
+            True if the payout structure is a ladder
+    """
+    radius_thresholds, magnitude_thresholds, percentages = _sort_payout_rules(*load_payout_table(payout_structure))
+    return bool(np.all(np.diff(magnitude_thresholds) >= 0) and np.all(np.diff(percentages) <= 0))
+
+def _compute_earthquake_payouts(distances, magnitudes, radius_thresholds, magnitude_thresholds, percentages):
+    """Computes the payout of each earthquake, with the rules of "compute_payout_item". Returns an array of payouts (in %).
+    For ladders (see "is_payout_ladder"), applicable rules of an earthquake are a contiguous range of the sorted rules, found by binary search,
+    and the first of them has the highest payout: memory and time are O(N_earthquakes * log(N_rules)).
+    Otherwise, all rules are tested for all earthquakes with a (N_earthquakes, N_rules) matrix.
+    """
+    radius_thresholds, magnitude_thresholds, percentages = _sort_payout_rules(radius_thresholds, magnitude_thresholds, percentages)
+
+    if percentages.shape[0] > 0 and np.all(np.diff(magnitude_thresholds) >= 0) and np.all(np.diff(percentages) <= 0):
+        #Applicable rules are those from the first rule with a large enough radius...
+        first_rule = np.searchsorted(radius_thresholds, distances, side="left")
+        #...up to the last rule with a low enough magnitude criteria (excluded). Missing magnitudes match no rule.
+        end_rule = np.where(np.isnan(magnitudes), 0, np.searchsorted(magnitude_thresholds, magnitudes, side="right"))
+        payouts = np.where(first_rule < end_rule, percentages[np.minimum(first_rule, percentages.shape[0] - 1)], 0.0)
+        return np.maximum(payouts, 0.0)
+
+    #For each earthquake (rows) and each payout rule (columns), keep the payout only if applicable. Then get the maximum per earthquake.
+    applicable = (distances[:, None] <= radius_thresholds[None, :]) & (magnitudes[:, None] >= magnitude_thresholds[None, :])
+    return np.where(applicable, percentages[None, :], 0.0).max(axis=1, initial=0.0)
+
+def make_payout_kernel(payout_structure):
+    """This function generates a compiled function computing the payout of earthquakes, specialized for a given payout structure.
+    Payout rules are hard-coded in the generated code, by decreasing payout: the first applicable rule gives the payout, without testing the others.
+    Generating and compiling takes time: this is worth it when the same payout structure is used for many earthquake batches.
+    Kernels are cached per payout structure.
+
+    Parameters
+    ---------- 
+        payout_structure: DataFrame or PayoutTable
+            Payout structure. See "compute_payout_item" doc for description
+
+    Returns
+    -------
+        function
+            payout_kernel(distances, magnitudes): takes two 1-D float64 arrays, returns the payout of each earthquake (in %) with the rules of "compute_payout_item"
+    """
+    payout_table = load_payout_table(payout_structure)
+    rules = tuple(zip(payout_table.radius.tolist(), payout_table.magnitude.tolist(), payout_table.percentage.tolist()))
+    return _make_payout_kernel(rules)
+
+@functools.lru_cache(maxsize=None)
+def _make_payout_kernel(rules):
+    """Cached "make_payout_kernel", with rules given as a tuple of (radius, magnitude, percentage) float tuples."""
+    #Highest payouts first. Rules without positive payout never apply (payout is at least 0).
+    rules = [rule for rule in sorted(rules, key=lambda rule: rule[2], reverse=True) if rule[2] > 0]
+
+    #Criteria are globals of the generated code, which numba compiles as constants
+    namespace = {"np": np}
+    source = "def payout_kernel(distances, magnitudes):\n"
+    source += "    payouts = np.zeros(distances.shape[0])\n"
+    if rules:
+        source += "    for i in range(distances.shape[0]):\n"
+        for index, (radius, magnitude, percentage) in enumerate(rules):
+            namespace.update({f"RADIUS_{index}": radius, f"MAGNITUDE_{index}": magnitude, f"PAYOUT_{index}": percentage})
+            source += f"        if distances[i] <= RADIUS_{index} and magnitudes[i] >= MAGNITUDE_{index}:\n"
+            source += f"            payouts[i] = PAYOUT_{index}\n"
+            source += "            continue\n"
+    source += "    return payouts\n"
+
+    exec(source, namespace)
+    return numba.njit(namespace["payout_kernel"])
+
 def compute_payouts(earthquake_data, payout_structure):
     """This function computes the payout for each year for which earthquake data is available, based on a list of earthquake events and a payout structure.
-    It uses "compute_payout_item" for payout computation rules (see there for description)
+    It applies the payout computation rules of "compute_payout_item" (see there for description) to all earthquakes at once.
 
     Parameters
     ---------- 
         earthquake_data: DataFrame
             DataFrame of earthquakes to take into account. Mandatory columns: 'time' (see "EARTHQUAKE_TIME_FORMAT" for format), 'mag', 'distance'.
-        payout_structure: DataFrame
-            DataFrame containing the payout structure. See "compute_payout_item" doc for description
+        payout_structure: DataFrame or PayoutTable
+            Payout structure. See "compute_payout_item" doc for description. Use "load_payout_table" to convert it once when reused.
 
     Returns
     -------
-        dict
-            key: year, value: payout applied on this year according to the payout structure (in %)
+        Series
+            index: year (sorted), value: payout applied on this year according to the payout structure (in %)
     """
-    #Initialize a dataframe matching each earthquake year to the eligible payout
-    df_earthquake_payouts = pd.DataFrame()
-    #For each earthquake, compute the applicable payout
-    df_earthquake_payouts[PAYOUT_COLUMN] = earthquake_data.apply(compute_payout_item,args=(payout_structure,), axis=1)
+    #Extract earthquake data and payout rules as numpy arrays
+    distances = earthquake_data[DISTANCE_COLUMN].to_numpy(dtype=np.float64)
+    magnitudes = earthquake_data[MAGNITUDE_COLUMN].to_numpy(dtype=np.float64)
+    payout_table = load_payout_table(payout_structure)
+
     #For each earthquake, retrieve the year
-    df_earthquake_payouts[YEAR_COLUMN] = earthquake_data[TIME_COLUMN].apply(datetime.datetime.strptime, args=(EARTHQUAKE_TIME_FORMAT,)).dt.year
-    #For each year, get the maximum applicable payout
-    df_yearly_payout = df_earthquake_payouts.groupby(YEAR_COLUMN, as_index=False)[PAYOUT_COLUMN].max()
+    years = pd.to_datetime(earthquake_data[TIME_COLUMN], format=EARTHQUAKE_TIME_FORMAT, utc=True, cache=True).dt.year.to_numpy(dtype=YEAR_DTYPE)
+    #For each earthquake, compute the applicable payout, indexed by year
+    earthquake_payouts = pd.Series(_compute_earthquake_payouts(distances, magnitudes, *payout_table), index=pd.Index(years, name=YEAR_COLUMN), name=PAYOUT_COLUMN)
+    #For each year, get the maximum applicable payout. Years are sorted at the end, once years without payout are removed.
+    yearly_payouts = earthquake_payouts.groupby(level=0, sort=False, observed=True).max()
     #Remove years with no payout (payout = 0) for clarity
-    df_yearly_payout.drop(df_yearly_payout[df_yearly_payout[PAYOUT_COLUMN] == 0].index, inplace = True)
-    #Format the output as a dict key/value = year/payout
-    return dict(zip(df_yearly_payout[YEAR_COLUMN], df_yearly_payout[PAYOUT_COLUMN]))
+    yearly_payouts = yearly_payouts[yearly_payouts > 0]
+    #Format the output as a Series year/payout, sorted by year
+    return yearly_payouts.sort_index()
+
+
+@numba.njit(fastmath=_FASTMATH_FLAGS, cache=True)
+def _yearly_payouts_kernel(blist_lat, blist_lon, magnitudes, year_indices, a_lat, a_lon, radius_thresholds, magnitude_thresholds, percentages, out):
+    """Compiled kernel of "compute_payouts_from_raw". Updates "out" (indexed by "year_indices") with the maximum payout per year.
+    Distances are computed on the fly and never stored. Payout rules are the ones of "compute_payout_item".
+    """
+    #Convert lat/lon of point A from decimal degrees to radians, once for all earthquakes
+    a_lambda = math.radians(a_lon)
+    a_phi = math.radians(a_lat)
+    cos_a_phi = math.cos(a_phi)
+
+    radius_max = radius_thresholds.max()
+    for i in range(blist_lat.shape[0]):
+        distance = _haversine(blist_lat[i], blist_lon[i], a_phi, a_lambda, cos_a_phi)
+        #Early rejection of earthquakes outside of all payout radii
+        if distance > radius_max:
+            continue
+        for j in range(radius_thresholds.shape[0]):
+            if distance <= radius_thresholds[j] and magnitudes[i] >= magnitude_thresholds[j] and percentages[j] > out[year_indices[i]]:
+                out[year_indices[i]] = percentages[j]
+
+def compute_payouts_from_raw(blist_lat, blist_lon, magnitudes, times, a_lat, a_lon, payout_structure, dtype=np.float32):
+    """This function computes the payout for each year, based on raw earthquake data and a payout structure.
+    It is equivalent to computing distances with "get_haversine_distance" then calling "compute_payouts", but computes
+    distances and payouts in a single compiled pass, without materializing distances.
+
+    Parameters
+    ---------- 
+        blist_lat: list of float
+            List of latitude of all earthquakes, in decimal degrees.
+        blist_lon: list of float
+            List of longitude of all earthquakes, in decimal degrees.
+        magnitudes: list of float
+            List of magnitude of all earthquakes.
+        times: list of str
+            List of time of all earthquakes (see "EARTHQUAKE_TIME_FORMAT" for format).
+        a_lat: float
+            Latitude of the point of interest, in decimal degrees.
+        a_lon: float
+            Longitude of the point of interest, in decimal degrees.
+        payout_structure: DataFrame or PayoutTable
+            Payout structure. See "compute_payout_item" doc for description. Use "load_payout_table" to convert it once when reused.
+        dtype: numpy float type, optional
+            Float type used for coordinates. See "get_haversine_distance".
+
+    Returns
+    -------
+        Series
+            index: year (sorted), value: payout applied on this year according to the payout structure (in %)
+
+    Raises
+    ------
+        ValueError
+            If blist_lat, blist_lon, magnitudes and times are not of the same length.
+    """
+    dtype = np.dtype(dtype).type #See "get_haversine_distance"
+
+    #Validate inputs: the kernel does not check bounds, so all earthquake inputs must be of the same length
+    lengths = {len(blist_lat), len(blist_lon), len(magnitudes), len(times)}
+    if len(lengths) > 1:
+        raise ValueError(f"compute_payouts_from_raw: blist_lat, blist_lon, magnitudes and times must have the same length ({len(blist_lat)}, {len(blist_lon)}, {len(magnitudes)}, {len(times)})")
+
+    payout_table = load_payout_table(payout_structure)
+    years = pd.to_datetime(pd.Series(times, dtype=object), format=EARTHQUAKE_TIME_FORMAT, utc=True, cache=True).dt.year.to_numpy(dtype=YEAR_DTYPE)
+    if years.shape[0] == 0 or payout_table.radius.shape[0] == 0:
+        return pd.Series(dtype=np.float64, index=pd.Index([], dtype=YEAR_DTYPE, name=YEAR_COLUMN), name=PAYOUT_COLUMN)
+
+    #Yearly payouts are stored in an array indexed by "year - first year"
+    first_year = years.min()
+    yearly_payouts = np.zeros(years.max() - first_year + 1, dtype=np.float64)
+    _yearly_payouts_kernel(
+        np.ascontiguousarray(blist_lat, dtype=dtype),
+        np.ascontiguousarray(blist_lon, dtype=dtype),
+        np.ascontiguousarray(magnitudes, dtype=np.float64),
+        np.ascontiguousarray(years - first_year, dtype=np.int64),
+        dtype(a_lat),
+        dtype(a_lon),
+        payout_table.radius,
+        payout_table.magnitude,
+        payout_table.percentage,
+        yearly_payouts
+    )
+
+    #Keep years with a payout only (payout > 0), for consistency with "compute_payouts"
+    (year_indices,) = np.nonzero(yearly_payouts)
+    return pd.Series(yearly_payouts[year_indices], index=pd.Index((year_indices + first_year).astype(YEAR_DTYPE), name=YEAR_COLUMN), name=PAYOUT_COLUMN)
 
 
 def compute_payout_item(earthquake_event, payout_structure):
@@ -120,8 +376,9 @@ def compute_burning_cost(payouts, start_year, end_year):
     The burning cost is the average of payouts over a time range. It is computed as follows: "sum of payouts per year" / "number of years"
     Parameters
     ---------- 
-        payouts: dict
-            key: year, value: payout applied on this year according to the payout structure (in %)
+        payouts: Series or dict
+            index/key: year, value: payout applied on this year according to the payout structure (in %). See "compute_payouts".
+            When computing many time ranges, pass a Series sorted by year to avoid converting/sorting it on each call.
         start_year: int
             first year of the time frame (included)
         end_year: int
@@ -140,8 +397,13 @@ def compute_burning_cost(payouts, start_year, end_year):
         print("compute_burning_cost - Warning: end_year must be above or equal to start_year")
 
     if valid_inputs:
+        #Get payouts as a Series sorted by year, to allow slicing on the time range
+        if isinstance(payouts, dict):
+            payouts = pd.Series(payouts, index=pd.Index(list(payouts), dtype=np.int64), dtype=np.float64)
+        if not payouts.index.is_monotonic_increasing:
+            payouts = payouts.sort_index()
         #Compute the sum of payouts per years within the time range
-        payout_sum = sum(payout for year, payout in payouts.items() if start_year <= year and year <= end_year)
+        payout_sum = payouts.loc[start_year:end_year].sum()
         #Divide by the number of years in the time range
         res = payout_sum / (end_year - start_year + 1)
     return res
\ No newline at end of file
@@ -1,10 +1,14 @@
 # --- IMPORTS --- 
 import urllib
+import numpy as np
 import pandas as pd 
 import datetime
+import functools
 import asyncio
 import aiohttp
 import io
+import joblib
+from earthquakes.tools import get_haversine_distance
 
 # --- CONSTANT DEFINITIONS ---
 # USGS API MANAGEMENT
@@ -16,11 +20,38 @@ USGS_API_PARAM_FORMAT_CSV = "csv"
 USGS_API_PARAM_FORMAT_JSON = "geojson"
 USGS_API_PARAM_ENDTIME = "endtime"
 USGS_API_PARAM_STARTTIME = "starttime"
-USGS_API_PARAM_STARTTIME_DEFAULT = datetime.datetime.now() - datetime.timedelta(days=200*365) #datetime 200 years from now
+USGS_API_PARAM_STARTTIME_DEFAULT_DAYS = 200*365 #Default start time is 200 years before today, see "get_default_starttime"
 USGS_API_PARAM_LATITUDE = "latitude"
 USGS_API_PARAM_LONGITUDE = "longitude"
 USGS_API_PARAM_RADIUS_KM = "maxradiuskm"
 USGS_API_PARAM_MIN_MAGN = "minmagnitude"
+USGS_API_MAX_CONCURRENT_REQUESTS = 8 #Maximum number of simultaneous calls to the USGS API, which rate-limits clients
+USGS_API_DNS_CACHE_TTL = 300 #Time to keep resolved USGS API addresses, in seconds
+
+# USGS DATA MODEL DEFINITION
+USGS_DATA_TIME_COLUMN = "time"
+USGS_DATA_LATITUDE_COLUMN = "latitude"
+USGS_DATA_LONGITUDE_COLUMN = "longitude"
+USGS_DATA_MAGNITUDE_COLUMN = "mag"
+#Explicit types of numerical columns, to skip type inference when parsing. Other columns are text ("time" is parsed later if needed).
+USGS_DATA_DTYPES = {
+    USGS_DATA_LATITUDE_COLUMN: np.float64,
+    USGS_DATA_LONGITUDE_COLUMN: np.float64,
+    "depth": np.float64,
+    USGS_DATA_MAGNITUDE_COLUMN: np.float64,
+    "nst": np.float64,
+    "gap": np.float64,
+    "dmin": np.float64,
+    "rms": np.float64,
+    "horizontalError": np.float64,
+    "depthError": np.float64,
+    "magError": np.float64,
+    "magNst": np.float64,
+}
+#Low-cardinality text columns, stored as categories when merging results of multiple queries
+USGS_DATA_CATEGORY_COLUMNS = ["magType", "net", "type"]
+#Columns required to compute payouts (see earthquakes.tools), to be passed as "columns" to limit parsing to those
+USGS_DATA_PAYOUT_COLUMNS = [USGS_DATA_TIME_COLUMN, USGS_DATA_LATITUDE_COLUMN, USGS_DATA_LONGITUDE_COLUMN, USGS_DATA_MAGNITUDE_COLUMN]
 
 # ASSET DATA MODEL DEFINITION
 ASSET_LATITUDE_COLUMN = "latitude"
@@ -30,6 +61,31 @@ ASSET_LONGITUDE_COLUMN = "longitude"
 HTTPCODE_OK = 200
 
 # --- FUNCTIONS ---
+def get_default_starttime(day=None):
+    """This function returns the default start time of "query" calls: 200 years before "day".
+
+    Parameters
+    ---------- 
+        day: date, optional
+            Reference day. Defaults to today, so that the start time does not get stale in long-running processes.
+
+    Returns
+    -------
+        str
+            Start time, as an ISO8601 date (e.g. '1826-12-03')
+    """
+    return _get_default_starttime(day or datetime.date.today())
+
+@functools.lru_cache(maxsize=1)
+def _get_default_starttime(day):
+    """Memoized "get_default_starttime": the string is only built once per day."""
+    return (day - datetime.timedelta(days=USGS_API_PARAM_STARTTIME_DEFAULT_DAYS)).isoformat()
+
+@functools.lru_cache(maxsize=1)
+def _get_query_url_prefix(starttime):
+    """Start of "query" URLs (see "build_api_query_url"), which only depends on the start time: method and start time, quoted once."""
+    return f"{USGS_API_BASE_URL}{USGS_API_METHOD_QUERY}?{USGS_API_PARAM_STARTTIME}={urllib.parse.quote_plus(starttime)}"
+
 def build_api_url(method,parameters=None):
     """This function build the URL to perform the desired call to USGS Earthquake API. See https://earthquake.usgs.gov/fdsnws/event/1/
     Note that no validity checks are performed.
@@ -53,6 +109,37 @@ def build_api_url(method,parameters=None):
     return res
 
 
+def _quote_number(value):
+    """Quotes a number for an URL: numbers are written with digits, ".", "-", "e" and "+" (exponent), of which only "+" must be quoted."""
+    return str(value).replace("+", "%2B")
+
+def build_api_query_url(latitude, longitude, radius, minimum_magnitude=None, end_date=None, format=None):
+    """This function builds the URL of a "query" call, equivalent to "build_api_url" called with "build_api_query_parameters".
+    As parameter names are fixed, the URL is formatted directly, without building and encoding a parameters dict.
+    Numerical parameters (latitude, longitude, radius, minimum_magnitude) must be numbers.
+
+    Parameters
+    ---------- 
+        See "build_api_query_parameters"
+
+    Returns
+    -------
+        str
+            URL for the API call
+    """
+    res = f"{_get_query_url_prefix(get_default_starttime())}&{USGS_API_PARAM_LATITUDE}={_quote_number(latitude)}&{USGS_API_PARAM_LONGITUDE}={_quote_number(longitude)}" \
+        f"&{USGS_API_PARAM_RADIUS_KM}={_quote_number(radius)}"
+    if minimum_magnitude:
+        res += f"&{USGS_API_PARAM_MIN_MAGN}={_quote_number(minimum_magnitude)}"
+
+    if end_date:
+        res += f"&{USGS_API_PARAM_ENDTIME}={urllib.parse.quote_plus(str(end_date))}"
+
+    if format:
+        res += f"&{USGS_API_PARAM_FORMAT}={urllib.parse.quote_plus(format)}"
+
+    return res
+
 def build_api_query_parameters(latitude, longitude, radius, minimum_magnitude=None, end_date=None, format=None):
     """This function build a dict ready to be passed to "build_api_url" as "parameters" argument for the "query" method.
     It defines parameters to retrieve earthquakes in a circle around the point of interest in the past 200 years (not configurable).
@@ -80,7 +167,7 @@ def build_api_query_parameters(latitude, longitude, radius, minimum_magnitude=No
     """
 
     parameters = {
-        USGS_API_PARAM_STARTTIME: USGS_API_PARAM_STARTTIME_DEFAULT,
+        USGS_API_PARAM_STARTTIME: get_default_starttime(),
         USGS_API_PARAM_LATITUDE: latitude,
         USGS_API_PARAM_LONGITUDE: longitude,
         USGS_API_PARAM_RADIUS_KM: radius
@@ -96,7 +183,30 @@ def build_api_query_parameters(latitude, longitude, radius, minimum_magnitude=No
 
     return parameters
 
-def get_earthquake_data(latitude, longitude, radius, minimum_magnitude=None, end_date=None):
+def read_earthquake_data(buffer, columns=None):
+    """This function parses a text-csv response of the USGS API "query" method to a DataFrame.
+    Numerical columns are parsed with the explicit types of USGS_DATA_DTYPES.
+
+    Parameters
+    ---------- 
+        buffer: file-like object
+            Text-csv data returned by the USGS API
+        columns: list of str, optional
+            If set, only those columns are parsed and returned, in this order (see USGS_DATA_PAYOUT_COLUMNS). Otherwise, all columns are returned.
+
+    Returns
+    -------
+        DataFrame
+            DataFrame with one earthquake per row.
+    """
+    if not columns:
+        return pd.read_csv(buffer, dtype=USGS_DATA_DTYPES, engine="c")
+
+    dtypes = {column: dtype for column, dtype in USGS_DATA_DTYPES.items() if column in columns}
+    #"usecols" keeps the order of the CSV data: reorder as requested
+    return pd.read_csv(buffer, usecols=columns, dtype=dtypes, engine="c")[list(columns)]
+
+def get_earthquake_data(latitude, longitude, radius, minimum_magnitude=None, end_date=None, columns=None):
     """This function retrieves a dataframe of all earthquakes in the circle of interest, and matching the additional criteria, from the USGS API. 
 
     Parameters
@@ -111,11 +221,13 @@ def get_earthquake_data(latitude, longitude, radius, minimum_magnitude=None, end
             When set, this allows to filter out earthquakes of a magnitude strictly lower than this value
         end_date: float, optional
             When set, this allows to filter out earthquakes that happened after the specified date. ISO8601 Date/Time format. Unless a timezone is specified, UTC is assumed (see API documentation)
+        columns: list of str, optional
+            When set, only those columns are parsed and returned (see USGS_DATA_PAYOUT_COLUMNS). Otherwise, all columns are returned.
     
     Returns
     -------
         DataFrame
-            DataFrame with one earthquake matching the criteria per row, containing all data available from the USGS API.
+            DataFrame with one earthquake matching the criteria per row, containing all data available from the USGS API (or "columns" only if set).
     """
     
     #Build the URL to perform a query operation
@@ -133,37 +245,136 @@ def get_earthquake_data(latitude, longitude, radius, minimum_magnitude=None, end
         print(f'get_earthquake_data: An unknown error occurred: {e}')
 
     #Parse the response to a DataFrame
-    data = pd.read_table(response, delimiter = ',')
+    data = read_earthquake_data(response, columns)
 
     return data
 
-async def get_earthquake_data_for_multiple_locations(assets, radius, minimum_magnitude=None, end_date=None):
+def group_locations(latitudes, longitudes, group_radius):
+    """This function greedily groups locations so that each location is within "group_radius" of the first location (center) of its group.
+    Each location belongs to exactly one group. Used to perform a single USGS query for locations close to each other.
+
+    Parameters
+    ---------- 
+        latitudes: list of float
+            List of latitude of all locations, in decimal degrees. Must be of the same length as longitudes
+        longitudes: list of float
+            List of longitude of all locations, in decimal degrees. Must be of the same length as latitudes
+        group_radius: float
+            Maximum distance between a location and the center of its group, in km
+
+    Returns
+    -------
+        list of ndarray of int
+            Indices of the locations of each group. The first index of each group is its center.
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+
+    groups = []
+    ungrouped = np.arange(latitudes.shape[0])
+    while ungrouped.shape[0] > 0:
+        #The first ungrouped location becomes a center, and takes all ungrouped locations around it
+        center = ungrouped[0]
+        distances = get_haversine_distance(latitudes[ungrouped], longitudes[ungrouped], latitudes[center], longitudes[center], dtype=np.float64)
+        in_group = distances <= group_radius
+        in_group[0] = True
+        groups.append(ungrouped[in_group])
+        ungrouped = ungrouped[~in_group]
+    return groups
+
+async def get_earthquake_data_for_multiple_locations(assets, radius, minimum_magnitude=None, end_date=None, columns=None, max_concurrent_requests=USGS_API_MAX_CONCURRENT_REQUESTS, group_radius=None, cache_dir=None):
     """This function retrieves a dataframe of all earthquakes in multiple circles of interest of a common radius, and matching the additional criteria, from the USGS API.
-    This function uses coroutines to perform one query per circle. 
+    This function uses coroutines to perform one query per circle, with at most "max_concurrent_requests" queries in flight. 
+    If "group_radius" is set, circles whose centers are close to each other are grouped (see "group_locations") and one query is performed per group,
+    with a radius enlarged to cover all circles of the group. Earthquakes are then filtered locally to keep those within "radius" of a circle center.
+    As USGS and "get_haversine_distance" distances may slightly differ, earthquakes at the very edge of a circle may differ from ungrouped queries.
+    If "cache_dir" and "end_date" are set, query responses are cached on disk (see "get_cached_query_function").
 
     Parameters
     ---------- 
+        assets: DataFrame
+            DataFrame with one circle center per row. Mandatory columns: ASSET_LATITUDE_COLUMN, ASSET_LONGITUDE_COLUMN (in decimal degrees)
+        radius: float
+            radius of the circles, in km
+        minimum_magnitude: float, optional
+            When set, this allows to filter out earthquakes of a magnitude strictly lower than this value
+        end_date: float, optional
+            When set, this allows to filter out earthquakes that happened after the specified date. ISO8601 Date/Time format. Unless a timezone is specified, UTC is assumed (see API documentation)
+        columns: list of str, optional
+            When set, only those columns are parsed and returned (see USGS_DATA_PAYOUT_COLUMNS). Otherwise, all columns are returned.
+        max_concurrent_requests: int, optional
+            Maximum number of simultaneous calls to the USGS API. Defaults to USGS_API_MAX_CONCURRENT_REQUESTS.
+        group_radius: float, optional
+            When set, circles whose centers are within this distance (in km) of a group center are retrieved with a single query.
+        cache_dir: str, optional
+            When set along with "end_date", query responses are read from/stored to this directory instead of always calling the USGS API.
         
     Returns
     -------
         DataFrame
-            DataFrame with one earthquake matching the criteria per row, containing all data available from the USGS API.
+            DataFrame with one earthquake matching the criteria per row, containing all data available from the USGS API (or "columns" only if set).
+            Rows are indexed from 0. Columns of USGS_DATA_CATEGORY_COLUMNS are categorical.
     """
-    async with aiohttp.ClientSession() as session:
+    latitudes = assets[ASSET_LATITUDE_COLUMN].to_numpy(dtype=np.float64)
+    longitudes = assets[ASSET_LONGITUDE_COLUMN].to_numpy(dtype=np.float64)
+
+    #Define one query per group of circles (one group per circle if grouping is disabled)
+    if group_radius:
+        groups = group_locations(latitudes, longitudes, group_radius)
+    else:
+        groups = [np.array([index]) for index in range(latitudes.shape[0])]
+    #Groups of several circles are queried with a radius enlarged to cover all of them. Single circles are queried with "radius" as is.
+    query_radiuses = [
+        radius + get_haversine_distance(latitudes[group], longitudes[group], latitudes[group[0]], longitudes[group[0]], dtype=np.float64).max() \
+        if group.shape[0] > 1 else radius \
+        for group in groups
+    ]
+
+    #Local filtering of grouped queries requires earthquake coordinates
+    parsed_columns = columns
+    if columns and len(groups) < latitudes.shape[0]:
+        parsed_columns = list(columns) + [column for column in (USGS_DATA_LATITUDE_COLUMN, USGS_DATA_LONGITUDE_COLUMN) if column not in columns]
+
+    #Past earthquakes do not change: queries up to a given end date can be cached. Without end date, results grow over time.
+    query_function = get_earthquake_data_for_single_location
+    if cache_dir and end_date:
+        query_function = get_cached_query_function(cache_dir)
+
+    #Bound the number of in-flight calls, and share a single connection pool (with DNS caching) among them
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+    connector = aiohttp.TCPConnector(limit=max_concurrent_requests, limit_per_host=max_concurrent_requests, ttl_dns_cache=USGS_API_DNS_CACHE_TTL)
+    async with aiohttp.ClientSession(connector=connector) as session:
         tasks = [asyncio.ensure_future( \
-                get_earthquake_data_for_single_location(session, location[ASSET_LATITUDE_COLUMN], location[ASSET_LONGITUDE_COLUMN], radius, minimum_magnitude, end_date) \
-            ) for index, location in assets.iterrows()]
-        responses = await asyncio.gather(*tasks) #Wait for all coroutines to end and gather results.
+                query_function(session, latitudes[group[0]], longitudes[group[0]], query_radius, minimum_magnitude, end_date, semaphore) \
+            ) for group, query_radius in zip(groups, query_radiuses)]
+        try:
+            responses = await asyncio.gather(*tasks) #Wait for all coroutines to end and gather results.
+        except Exception:
+            #Do not leave remaining calls running when one of them fails
+            for task in tasks:
+                task.cancel()
+            raise
 
         #Gathered results must be merged within the same DataFrame
         data_unit_list = [] #List of all unit dataframes
-        for response in responses:
-            data_unit = pd.read_csv(io.StringIO(response)) #Convert the response to a dataframe
+        for group, response in zip(groups, responses):
+            data_unit = read_earthquake_data(io.StringIO(response), parsed_columns) #Convert the response to a dataframe
+            if group.shape[0] > 1:
+                #Keep only earthquakes within the radius of at least one circle of the group
+                in_circles = np.zeros(len(data_unit), dtype=bool)
+                for index in group:
+                    in_circles |= get_haversine_distance(data_unit[USGS_DATA_LATITUDE_COLUMN], data_unit[USGS_DATA_LONGITUDE_COLUMN], latitudes[index], longitudes[index], dtype=np.float64) <= radius
+                data_unit = data_unit[in_circles]
+            if columns:
+                data_unit = data_unit[list(columns)] #Drop coordinates parsed for filtering only, if any
             data_unit_list.append(data_unit) #Store it in the list
-        data = pd.concat(data_unit_list).drop_duplicates() #Merge all unit dataframe into a single one
+        #Merge all unit dataframes into a single one. All of them share the same columns and types (see "read_earthquake_data")
+        data = pd.concat(data_unit_list, ignore_index=True, sort=False).drop_duplicates(ignore_index=True)
+        #Store low-cardinality text columns as categories
+        data = data.astype({column: "category" for column in USGS_DATA_CATEGORY_COLUMNS if column in data.columns})
     return data
 
-async def get_earthquake_data_for_single_location(session, latitude, longitude, radius, minimum_magnitude, end_date):
+async def get_earthquake_data_for_single_location(session, latitude, longitude, radius, minimum_magnitude, end_date, semaphore=None):
     """This function handles a coroutine to perform one call to USGS API. 
     It retrieves a text-csv string of all earthquakes in a circle of interest, and matching the additional criteria, from the USGS API. 
 
@@ -180,6 +391,8 @@ async def get_earthquake_data_for_single_location(session, latitude, longitude,
             When set, this allows to filter out earthquakes of a magnitude strictly lower than this value
         end_date: float, optional
             When set, this allows to filter out earthquakes that happened after the specified date. ISO8601 Date/Time format. Unless a timezone is specified, UTC is assumed (see API documentation)
+        semaphore: asyncio.Semaphore, optional
+            When set, the call is performed only once the semaphore is acquired. Used to bound the number of simultaneous calls.
     
     Returns
     -------
@@ -188,11 +401,31 @@ async def get_earthquake_data_for_single_location(session, latitude, longitude,
     """
 
     #Build the URL to perform a query operation
-    parameters = build_api_query_parameters(latitude, longitude, radius, minimum_magnitude, end_date,USGS_API_PARAM_FORMAT_CSV)
-    url = build_api_url(USGS_API_METHOD_QUERY, parameters)
+    url = build_api_query_url(latitude, longitude, radius, minimum_magnitude, end_date, USGS_API_PARAM_FORMAT_CSV)
+
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(1) #Standalone call: nothing to bound
 
     #Perform the API Call and retrieve the response
-    async with session.get(url) as response:
-        assert response.status == HTTPCODE_OK #Ensure the call is successful
-        data = await response.text()
-    return data
\ No newline at end of file
+    async with semaphore:
+        async with session.get(url) as response:
+            assert response.status == HTTPCODE_OK #Ensure the call is successful
+            data = await response.text()
+    return data
+
+def get_cached_query_function(cache_dir):
+    """This function returns "get_earthquake_data_for_single_location" with its responses cached on disk.
+    Responses are keyed by the query criteria (latitude, longitude, radius, minimum_magnitude, end_date): on a hit, the USGS API is not called.
+    Only use it for queries with an end date in the past, as results of other queries change over time.
+
+    Parameters
+    ---------- 
+        cache_dir: str
+            Directory where responses are stored. Created if needed.
+
+    Returns
+    -------
+        coroutine function
+            Same signature and return value as "get_earthquake_data_for_single_location"
+    """
+    return joblib.Memory(cache_dir, verbose=0).cache(get_earthquake_data_for_single_location, ignore=["session", "semaphore"])
@@ -0,0 +1,16 @@
+from earthquakes.tools import load_payout_table
+import pytest
+import numpy
+import pandas
+
+NUMBER_OF_EARTHQUAKES = 1000
+
+@pytest.fixture
+def earthquake_arrays():
+  """Random earthquakes as typed arrays, and a payout ladder: (distances, magnitudes, years, payout_table)"""
+  random_state = numpy.random.RandomState(0)
+  distances = random_state.uniform(0, 300, NUMBER_OF_EARTHQUAKES).astype(numpy.float32)
+  magnitudes = numpy.round(random_state.uniform(4, 8, NUMBER_OF_EARTHQUAKES), 1).astype(numpy.float32)
+  years = random_state.randint(1950, 2022, NUMBER_OF_EARTHQUAKES).astype(numpy.int32)
+  payout_table = load_payout_table(pandas.DataFrame([[10, 4.5, 100], [50, 5.5, 75], [200, 6.5, 50]], columns=['Radius', 'Magnitude', 'Payout']))
+  return distances, magnitudes, years, payout_table
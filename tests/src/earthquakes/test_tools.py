@@ -1,6 +1,7 @@
-from earthquakes.tools import get_haversine_distance
+from earthquakes.tools import get_haversine_distance, compute_payouts, compute_payout_item, compute_payouts_from_raw, compute_burning_cost, is_payout_ladder, load_payout_table, PayoutTable, make_payout_kernel
 import pytest
 import numpy
+import pandas
 
 # --- build_api_url - Unit Tests ---
 # Refer to https://www.vcalc.com/wiki/vCalc/Haversine+-+Distance to check computations
@@ -17,4 +18,187 @@ def test_get_haversine_distance(blist_lat,blist_lon,a_lat,a_lon,expected):
   # Act
   res = get_haversine_distance(blist_lat,blist_lon,a_lat,a_lon)
   # Assert
-  numpy.testing.assert_allclose(res, expected, rtol=0.01)
\ No newline at end of file
+  numpy.testing.assert_allclose(res, expected, rtol=0.01)
+
+@pytest.mark.parametrize("dtype", [numpy.float32, numpy.float64, numpy.dtype('float32'), numpy.dtype('float64'), 'float64'])
+def test_get_haversine_distance_dtype(dtype):
+  # Arrange
+  # Act
+  res = get_haversine_distance([60, 0, -27.6], [-30, 89, 3.7], 2.22, -12, dtype=dtype)
+  # Assert
+  assert res.dtype == numpy.dtype(dtype)
+  numpy.testing.assert_allclose(res, [6607.38, 11229.77, 3717.32], rtol=0.01)
+
+@pytest.mark.parametrize("blist_lat, blist_lon", [
+    ([35, 36, 37, 38, 39], [25, 25]),
+    ([35], [25, 26]),
+    (35, 25),
+    ([[35, 36]], [[25, 25]]),
+])
+def test_get_haversine_distance_invalid_points(blist_lat, blist_lon):
+  # Arrange
+  # Act
+  # Assert
+  with pytest.raises(ValueError):
+    get_haversine_distance(blist_lat, blist_lon, 35, 25)
+
+def test_get_haversine_distance_returns_ndarray():
+  # Arrange
+  earthquake_data = pandas.DataFrame({'latitude': [60, 0, -27.6], 'longitude': [-30, 89, 3.7]})
+  # Act
+  earthquake_data['distance'] = get_haversine_distance(earthquake_data['latitude'].to_numpy(), earthquake_data['longitude'].to_numpy(), 2.22, -12)
+  # Assert
+  assert earthquake_data['distance'].dtype == numpy.float32
+  numpy.testing.assert_allclose(earthquake_data['distance'], [6607.38, 11229.77, 3717.32], rtol=0.01)
+
+# --- compute_payouts - Unit Tests ---
+PAYOUT_STRUCTURE = pandas.DataFrame([[10, 4.5, 100], [50, 5.5, 75], [200, 6.5, 50]], columns=['Radius', 'Magnitude', 'Payout'])
+
+@pytest.mark.parametrize("earthquakes, expected", [
+    ([["2021-10-12T09:24:05.099Z", 5, 4.6]], {2021: 100}),
+    ([["2021-10-12T09:24:05.099Z", 5, 4.4]], {}),
+    ([["2021-10-12T09:24:05.099Z", 40, 5.6], ["2021-01-12T09:24:05.099Z", 150, 7]], {2021: 75}),
+    ([["2020-10-12T09:24:05.099Z", 150, 7], ["2021-01-12T09:24:05.099Z", 250, 9]], {2020: 50}),
+    ([["1990-10-12T09:24:05.099Z", 1, 8], ["2021-01-12T09:24:05.099Z", 30, 6]], {1990: 100, 2021: 75}),
+])
+def test_compute_payouts(earthquakes, expected):
+  # Arrange
+  earthquake_data = pandas.DataFrame(earthquakes, columns=['time', 'distance', 'mag'])
+  # Act
+  res = compute_payouts(earthquake_data, PAYOUT_STRUCTURE)
+  # Assert
+  assert isinstance(res, pandas.Series)
+  assert res.to_dict() == expected
+
+
+@pytest.mark.parametrize("payout_items, is_ladder", [
+    ([[10, 4.5, 100], [50, 5.5, 75], [200, 6.5, 50]], True),
+    ([[200, 6.5, 50], [10, 4.5, 100], [50, 5.5, 75]], True),
+    ([[10, 4.5, 100], [10, 5, 100], [50, 5, 60], [50, 5, 75]], True),
+    ([[10, 6.5, 100], [50, 5.5, 75], [200, 4.5, 50]], False),
+    ([[10, 4.5, 50], [50, 5.5, 75], [200, 6.5, 100]], False),
+    ([], True),
+])
+def test_compute_payouts_matches_compute_payout_item(payout_items, is_ladder):
+  # Arrange
+  random_state = numpy.random.RandomState(0)
+  payout_structure = pandas.DataFrame(payout_items, columns=['Radius', 'Magnitude', 'Payout'], dtype=float)
+  earthquake_data = pandas.DataFrame({
+    'time': random_state.choice(["2001-10-12T09:24:05.099Z", "2002-10-12T09:24:05.099Z", "2003-10-12T09:24:05.099Z"], 500),
+    'distance': random_state.choice([0, 10, 30, 50, 150, 200, 300], 500),
+    'mag': random_state.choice([4, 4.5, 5, 5.5, 6, 6.5, 7, numpy.nan], 500),
+  })
+  payout_per_earthquake = earthquake_data.apply(compute_payout_item, args=(payout_structure,), axis=1).fillna(0)
+  expected = payout_per_earthquake.groupby(earthquake_data['time'].str.slice(0, 4).astype(int)).max()
+  # Act
+  res = compute_payouts(earthquake_data, payout_structure)
+  # Assert
+  assert res.to_dict() == expected[expected > 0].to_dict()
+  assert is_payout_ladder(payout_structure) == is_ladder
+
+def test_compute_payouts_with_payout_table():
+  # Arrange
+  earthquake_data = pandas.DataFrame([["1990-10-12T09:24:05.099Z", 1, 8], ["2021-01-12T09:24:05.099Z", 30, 6]], columns=['time', 'distance', 'mag'])
+  payout_table = load_payout_table(PAYOUT_STRUCTURE)
+  # Act
+  res = compute_payouts(earthquake_data, payout_table)
+  # Assert
+  assert res.to_dict() == {1990: 100, 2021: 75}
+
+# --- load_payout_table - Unit Tests ---
+def test_load_payout_table():
+  # Arrange
+  # Act
+  res = load_payout_table(PAYOUT_STRUCTURE)
+  # Assert
+  assert isinstance(res, PayoutTable)
+  for array, expected in zip(res, ([10, 50, 200], [4.5, 5.5, 6.5], [100, 75, 50])):
+    assert array.dtype == numpy.float64
+    assert array.flags['C_CONTIGUOUS']
+    numpy.testing.assert_array_equal(array, expected)
+  assert load_payout_table(res) is res
+
+# --- make_payout_kernel - Unit Tests ---
+@pytest.mark.parametrize("payout_items", [
+    [[10, 4.5, 100], [50, 5.5, 75], [200, 6.5, 50]],
+    [[10, 6.5, 100], [50, 5.5, 75], [200, 4.5, 50]],
+    [[10, 4.55, 12.3], [50, 5.5, 0], [200, 6.5, -10], [numpy.inf, 7, 5]],
+    [],
+])
+def test_make_payout_kernel(payout_items):
+  # Arrange
+  random_state = numpy.random.RandomState(0)
+  payout_structure = pandas.DataFrame(payout_items, columns=['Radius', 'Magnitude', 'Payout'], dtype=float)
+  earthquake_data = pandas.DataFrame({
+    'distance': random_state.choice([0, 10, 30, 50, 150, 200, 300], 500),
+    'mag': random_state.choice([4, 4.5, 4.55, 5, 5.5, 6, 6.5, 7, numpy.nan], 500),
+  })
+  expected = earthquake_data.apply(compute_payout_item, args=(payout_structure,), axis=1).fillna(0).clip(lower=0)
+  # Act
+  payout_kernel = make_payout_kernel(payout_structure)
+  res = payout_kernel(earthquake_data['distance'].to_numpy(dtype=float), earthquake_data['mag'].to_numpy())
+  # Assert
+  numpy.testing.assert_array_equal(res, expected)
+  assert make_payout_kernel(load_payout_table(payout_structure)) is payout_kernel
+
+def test_make_payout_kernel_arrays(earthquake_arrays):
+  # Arrange
+  distances, magnitudes, years, payout_table = earthquake_arrays
+  earthquake_data = pandas.DataFrame({'time': numpy.char.add(years.astype(str), '-01-01T00:00:00.000Z'), 'distance': distances, 'mag': magnitudes})
+  # Act
+  payouts = make_payout_kernel(payout_table)(distances.astype(numpy.float64), magnitudes.astype(numpy.float64))
+  res = pandas.Series(payouts).groupby(years).max()
+  # Assert
+  assert res[res > 0].to_dict() == compute_payouts(earthquake_data, payout_table).to_dict()
+
+# --- compute_payouts_from_raw - Unit Tests ---
+@pytest.mark.parametrize("earthquakes, expected", [
+    ([], {}),
+    ([["2021-10-12T09:24:05.099Z", 35.0, 25.0, 4.6]], {2021: 100}),
+    ([["2021-10-12T09:24:05.099Z", 35.0, 25.0, 4.4]], {}),
+    ([["2021-10-12T09:24:05.099Z", 35.3, 25.0, 5.6], ["2021-01-12T09:24:05.099Z", 36.0, 25.0, 7]], {2021: 75}),
+    ([["2020-10-12T09:24:05.099Z", 36.0, 25.0, 7], ["2021-01-12T09:24:05.099Z", 40.0, 25.0, 9]], {2020: 50}),
+    ([["1990-10-12T09:24:05.099Z", 35.0, 25.0, 8], ["2021-01-12T09:24:05.099Z", 35.0, 25.5, 6]], {1990: 100, 2021: 75}),
+])
+def test_compute_payouts_from_raw(earthquakes, expected):
+  # Arrange
+  earthquake_data = pandas.DataFrame(earthquakes, columns=['time', 'latitude', 'longitude', 'mag'])
+  earthquake_data['distance'] = get_haversine_distance(earthquake_data['latitude'], earthquake_data['longitude'], 35.0, 25.0)
+  # Act
+  res = compute_payouts_from_raw(earthquake_data['latitude'], earthquake_data['longitude'], earthquake_data['mag'], earthquake_data['time'], 35.0, 25.0, PAYOUT_STRUCTURE)
+  res_dtype = compute_payouts_from_raw(earthquake_data['latitude'], earthquake_data['longitude'], earthquake_data['mag'], earthquake_data['time'], 35.0, 25.0, PAYOUT_STRUCTURE, dtype=numpy.dtype('float64'))
+  # Assert
+  assert res.to_dict() == expected
+  pandas.testing.assert_series_equal(res, compute_payouts(earthquake_data, PAYOUT_STRUCTURE))
+  pandas.testing.assert_series_equal(res_dtype, res)
+
+@pytest.mark.parametrize("blist_lat, blist_lon, magnitudes, times", [
+    ([35, 35, 35], [25], [5, 5, 5], ["2021-10-12T09:24:05.099Z"] * 3),
+    ([35, 35], [25, 25], [5, 5, 5], ["2021-10-12T09:24:05.099Z"] * 3),
+    ([35, 35], [25, 25], [5, 5], ["2021-10-12T09:24:05.099Z"]),
+])
+def test_compute_payouts_from_raw_mismatched_lengths(blist_lat, blist_lon, magnitudes, times):
+  # Arrange
+  # Act
+  # Assert
+  with pytest.raises(ValueError):
+    compute_payouts_from_raw(blist_lat, blist_lon, magnitudes, times, 35.0, 25.0, PAYOUT_STRUCTURE)
+
+
+# --- compute_burning_cost - Unit Tests ---
+@pytest.mark.parametrize("payouts, start_year, end_year, expected", [
+    ({}, 2000, 2009, 0),
+    ({2001: 50, 2005: 100}, 2000, 2009, 15),
+    ({2005: 100, 2001: 50}, 2000, 2009, 15),
+    ({1999: 75, 2001: 50, 2010: 100}, 2000, 2009, 5),
+    ({2001: 50, 2005: 100}, 2005, 2005, 100),
+    (pandas.Series([50, 100], index=[2001, 2005]), 2000, 2009, 15),
+    (pandas.Series([100, 50], index=[2005, 2001]), 2001, 2004, 12.5),
+    ({2001: 50, 2005: 100}, 2009, 2000, 0),
+])
+def test_compute_burning_cost(payouts, start_year, end_year, expected):
+  # Arrange
+  # Act
+  res = compute_burning_cost(payouts, start_year, end_year)
+  # Assert
+  assert res == pytest.approx(expected)
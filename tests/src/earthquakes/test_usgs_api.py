@@ -1,6 +1,13 @@
-from earthquakes.usgs_api import build_api_url, build_api_query_parameters
+from earthquakes.usgs_api import get_default_starttime, build_api_url, build_api_query_parameters, build_api_query_url, read_earthquake_data, get_earthquake_data_for_single_location, get_earthquake_data_for_multiple_locations, group_locations, get_cached_query_function
+from earthquakes.tools import get_haversine_distance
+from earthquakes import usgs_api
 import pytest
 import datetime
+import asyncio
+import io
+import urllib
+import numpy
+import pandas
 
 # --- build_api_url - Unit Tests ---
 @pytest.mark.parametrize("method", [
@@ -47,7 +54,7 @@ def test_build_api_url_with_empty_params():
 ])
 def test_build_api_query_parameters(latitude, longitude, radius, minimum_magnitude, end_date, format):
   # Arrange
-  expected = {"maxradiuskm": radius, "longitude": longitude, "latitude": latitude, "starttime": datetime.datetime.now() - datetime.timedelta(days=200*365)}
+  expected = {"maxradiuskm": radius, "longitude": longitude, "latitude": latitude, "starttime": datetime.date.today() - datetime.timedelta(days=200*365)}
   if minimum_magnitude:
     expected["minmagnitude"]=minimum_magnitude
 
@@ -60,6 +67,251 @@ def test_build_api_query_parameters(latitude, longitude, radius, minimum_magnitu
   # Act
   res = build_api_query_parameters(latitude, longitude, radius, minimum_magnitude, end_date, format)
   # Assert
-  assert abs(res["starttime"] - expected["starttime"]) < datetime.timedelta(hours=1)
+  assert abs(datetime.date.fromisoformat(res["starttime"]) - expected["starttime"]) <= datetime.timedelta(days=1)
   del res["starttime"] ; del expected["starttime"]
   assert res == expected
+
+# --- get_default_starttime - Unit Tests ---
+@pytest.mark.parametrize("day, expected", [
+    (datetime.date(year=2026, month=10, day=15), '1826-12-03'),
+    (datetime.date(year=2021, month=10, day=21), '1821-12-09'),
+])
+def test_get_default_starttime(day, expected):
+  # Arrange
+  # Act
+  res = get_default_starttime(day)
+  # Assert
+  assert res == expected
+
+def test_get_default_starttime_today():
+  # Arrange
+  # Act
+  res = get_default_starttime()
+  # Assert
+  assert res == get_default_starttime(datetime.date.today())
+
+# --- build_api_query_url - Unit Tests ---
+@pytest.mark.parametrize("latitude, longitude, radius, minimum_magnitude, end_date, format", [
+    (1,2,3,None,None,None),
+    (-1,5,23,1,None,None),
+    (0.001, 1000000, 1e24,-1,None,None),
+    (0.001, 100, 7 ,10,'2022-01-01',None),
+    (0.001, 100, 7 ,10,datetime.datetime(year=2021, month=10, day=21),None),
+    (0.001, 100, 7 ,None,datetime.datetime(year=2021, month=10, day=21),'csv'),
+    (0.001, 100, 7 ,0,None,'csv'),
+    (numpy.float64(35.025), numpy.float64(25.763), 200, 4.5, datetime.datetime(year=2021, month=10, day=21),'csv'),
+])
+def test_build_api_query_url(latitude, longitude, radius, minimum_magnitude, end_date, format):
+  # Arrange
+  expected = build_api_url('query', build_api_query_parameters(latitude, longitude, radius, minimum_magnitude, end_date, format))
+  # Act
+  res = build_api_query_url(latitude, longitude, radius, minimum_magnitude, end_date, format)
+  # Assert
+  assert res == expected
+
+# --- read_earthquake_data - Unit Tests ---
+USGS_CSV = """time,latitude,longitude,depth,mag,magType,nst,gap,dmin,rms,net,id,updated,place,type,horizontalError,depthError,magError,magNst,status,locationSource,magSource
+2021-10-12T09:24:05.099Z,35.1691,26.2152,20,6.4,mww,,19,0.86,0.46,us,us6000ftxu,2021-12-18T19:58:57.040Z,"4 km SW of Palekastro, Greece",earthquake,6.1,1.8,0.048,42,reviewed,us,us
+2021-10-03T14:31:27.622Z,35.1442,25.2375,10,4.6,mb,,119,0.318,0.64,us,us6000fsp1,2021-12-10T21:14:19.040Z,"2 km W of Arkalochóri, Greece",earthquake,5,1.9,0.165,13,reviewed,us,us
+"""
+
+@pytest.mark.parametrize("columns, expected_columns", [
+    (None, ['time', 'latitude', 'longitude', 'depth', 'mag', 'magType', 'nst', 'gap', 'dmin', 'rms', 'net', 'id', 'updated', 'place', 'type', 'horizontalError', 'depthError', 'magError', 'magNst', 'status', 'locationSource', 'magSource']),
+    (['time', 'latitude', 'longitude', 'mag'], ['time', 'latitude', 'longitude', 'mag']),
+    (['mag', 'place'], ['mag', 'place']),
+    (['mag', 'time'], ['mag', 'time']),
+    (['place', 'longitude', 'mag'], ['place', 'longitude', 'mag']),
+])
+def test_read_earthquake_data(columns, expected_columns):
+  # Arrange
+  # Act
+  res = read_earthquake_data(io.StringIO(USGS_CSV), columns)
+  # Assert
+  assert list(res.columns) == expected_columns
+  assert len(res) == 2
+  assert res['mag'].dtype == numpy.float64
+  assert res['mag'].tolist() == [6.4, 4.6]
+
+def test_read_earthquake_data_empty():
+  # Arrange
+  # Act
+  res = read_earthquake_data(io.StringIO(USGS_CSV.splitlines()[0]), ['time', 'mag'])
+  # Assert
+  assert len(res) == 0
+  assert res['mag'].dtype == numpy.float64
+
+# --- get_earthquake_data_for_single_location - Unit Tests ---
+class FakeResponse:
+  def __init__(self, session):
+    self.session = session
+    self.status = 200
+
+  async def __aenter__(self):
+    self.session.in_flight += 1
+    self.session.max_in_flight = max(self.session.max_in_flight, self.session.in_flight)
+    return self
+
+  async def __aexit__(self, *args):
+    self.session.in_flight -= 1
+
+  async def text(self):
+    await asyncio.sleep(0.01)
+    return self.session.url
+
+class FakeSession:
+  def __init__(self):
+    self.in_flight = 0
+    self.max_in_flight = 0
+    self.calls = 0
+
+  def get(self, url):
+    self.calls += 1
+    self.url = url
+    return FakeResponse(self)
+
+@pytest.mark.parametrize("max_concurrent_requests", [1, 3, 8])
+def test_get_earthquake_data_for_single_location_semaphore(max_concurrent_requests):
+  # Arrange
+  session = FakeSession()
+  async def run():
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+    return await asyncio.gather(*[get_earthquake_data_for_single_location(session, 1, 2, 3, None, None, semaphore) for i in range(10)])
+  # Act
+  res = asyncio.run(run())
+  # Assert
+  assert len(res) == 10
+  assert session.max_in_flight == max_concurrent_requests
+
+# --- group_locations - Unit Tests ---
+@pytest.mark.parametrize("latitudes, longitudes, group_radius, expected", [
+    ([], [], 100, []),
+    ([35], [25], 100, [[0]]),
+    ([35, 35.5, 40], [25, 25, 25], 100, [[0, 1], [2]]),
+    ([35, 35.5, 40], [25, 25, 25], 10, [[0], [1], [2]]),
+    ([35, 40, 35.5, 40.1], [25, 25, 25, 25], 100, [[0, 2], [1, 3]]),
+    ([35, 35.5, 40], [25, 25, 25], 1000, [[0, 1, 2]]),
+])
+def test_group_locations(latitudes, longitudes, group_radius, expected):
+  # Arrange
+  # Act
+  res = group_locations(latitudes, longitudes, group_radius)
+  # Assert
+  assert [group.tolist() for group in res] == expected
+
+# --- get_cached_query_function - Unit Tests ---
+def test_get_cached_query_function(tmp_path):
+  # Arrange
+  session = FakeSession()
+  query_function = get_cached_query_function(str(tmp_path))
+  end_date = datetime.datetime(year=2021, month=10, day=21)
+  other_session = FakeSession()
+  # Act
+  first = asyncio.run(query_function(session, 1, 2, 3, 4.5, end_date))
+  second = asyncio.run(query_function(other_session, 1, 2, 3, 4.5, end_date))
+  other = asyncio.run(query_function(other_session, 1, 2, 30, 4.5, end_date))
+  # Assert
+  assert first == second
+  assert "maxradiuskm=3&" in first
+  assert "maxradiuskm=30&" in other
+  assert session.calls == 1
+  assert other_session.calls == 1
+
+# --- get_earthquake_data_for_multiple_locations - Unit Tests ---
+# Earthquakes known by the fake USGS API: a is close to asset 0, b to asset 1, c to both, e to none (but within a grouped query)
+USGS_CATALOG = pandas.DataFrame([
+    ["2001-01-01T00:00:00.000Z", 35.0, 25.0, 5.0, "mb", "us", "a", "earthquake"],
+    ["2002-01-01T00:00:00.000Z", 35.5, 25.2, 6.0, "mww", "us", "b", "earthquake"],
+    ["2003-01-01T00:00:00.000Z", 35.25, 25.0, 4.6, "mb", "at", "c", "earthquake"],
+    ["2004-01-01T00:00:00.000Z", 35.25, 25.7, 4.8, "mb", "us", "e", "earthquake"],
+  ], columns=['time', 'latitude', 'longitude', 'mag', 'magType', 'net', 'id', 'type'])
+ASSETS = pandas.DataFrame([[35.0, 25.0], [35.5, 25.0]], columns=['latitude', 'longitude'])
+
+class FakeClientResponse:
+  def __init__(self, url):
+    self.status = 200
+    self.url = url
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *args):
+    pass
+
+  async def text(self):
+    #Return catalog earthquakes within the circle of the query
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(self.url).query)
+    distances = get_haversine_distance(USGS_CATALOG['latitude'], USGS_CATALOG['longitude'], float(query['latitude'][0]), float(query['longitude'][0]), dtype=numpy.float64)
+    return USGS_CATALOG[distances <= float(query['maxradiuskm'][0])].to_csv(index=False)
+
+class FakeClientSession:
+  urls = []
+
+  def __init__(self, connector=None):
+    pass
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *args):
+    pass
+
+  def get(self, url):
+    FakeClientSession.urls.append(url)
+    return FakeClientResponse(url)
+
+@pytest.fixture
+def fake_usgs_api(monkeypatch):
+  """Replaces aiohttp sessions used by usgs_api with FakeClientSession. Returns the list of called URLs."""
+  FakeClientSession.urls = []
+  monkeypatch.setattr(usgs_api.aiohttp, "ClientSession", FakeClientSession)
+  monkeypatch.setattr(usgs_api.aiohttp, "TCPConnector", lambda **kwargs: None)
+  return FakeClientSession.urls
+
+def get_query_parameters(url):
+  query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+  return query['latitude'][0], query['maxradiuskm'][0]
+
+def test_get_earthquake_data_for_multiple_locations(fake_usgs_api):
+  # Arrange
+  # Act
+  res = asyncio.run(get_earthquake_data_for_multiple_locations(ASSETS, 50))
+  # Assert
+  assert sorted(get_query_parameters(url) for url in fake_usgs_api) == [('35.0', '50'), ('35.5', '50')]
+  assert res['id'].tolist() == ['a', 'c', 'b']
+  assert res.index.tolist() == [0, 1, 2]
+  assert list(res.columns) == list(USGS_CATALOG.columns)
+  for column in ['magType', 'net', 'type']:
+    assert isinstance(res[column].dtype, pandas.CategoricalDtype)
+  assert res['mag'].dtype == numpy.float64
+
+def test_get_earthquake_data_for_multiple_locations_grouped(fake_usgs_api):
+  # Arrange
+  # Act
+  res = asyncio.run(get_earthquake_data_for_multiple_locations(ASSETS, 50, group_radius=100))
+  # Assert
+  assert len(fake_usgs_api) == 1
+  latitude, query_radius = get_query_parameters(fake_usgs_api[0])
+  assert latitude == '35.0'
+  assert float(query_radius) == pytest.approx(50 + get_haversine_distance([35.5], [25.0], 35.0, 25.0, dtype=numpy.float64)[0])
+  assert res['id'].tolist() == ['a', 'b', 'c']
+  assert res.index.tolist() == [0, 1, 2]
+  for column in ['magType', 'net', 'type']:
+    assert isinstance(res[column].dtype, pandas.CategoricalDtype)
+
+@pytest.mark.parametrize("columns, group_radius, expected_times", [
+    (['time', 'mag'], None, ["2001-01-01T00:00:00.000Z", "2003-01-01T00:00:00.000Z", "2002-01-01T00:00:00.000Z"]),
+    (['time', 'mag'], 100, ["2001-01-01T00:00:00.000Z", "2002-01-01T00:00:00.000Z", "2003-01-01T00:00:00.000Z"]),
+    (['time', 'net'], 100, ["2001-01-01T00:00:00.000Z", "2002-01-01T00:00:00.000Z", "2003-01-01T00:00:00.000Z"]),
+    (['mag', 'time'], None, ["2001-01-01T00:00:00.000Z", "2003-01-01T00:00:00.000Z", "2002-01-01T00:00:00.000Z"]),
+    (['mag', 'time'], 100, ["2001-01-01T00:00:00.000Z", "2002-01-01T00:00:00.000Z", "2003-01-01T00:00:00.000Z"]),
+])
+def test_get_earthquake_data_for_multiple_locations_columns(fake_usgs_api, columns, group_radius, expected_times):
+  # Arrange
+  # Act
+  res = asyncio.run(get_earthquake_data_for_multiple_locations(ASSETS, 50, columns=columns, group_radius=group_radius))
+  # Assert
+  assert list(res.columns) == columns
+  assert res['time'].tolist() == expected_times
+  assert res.index.tolist() == [0, 1, 2]
+  if 'net' in columns:
+    assert isinstance(res['net'].dtype, pandas.CategoricalDtype)